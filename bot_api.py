@@ -2,6 +2,7 @@ import os
 import logging
 from dotenv import load_dotenv
 from telegram import Bot, Update
+from telegram.request import HTTPXRequest
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 import asyncio
 from datetime import datetime, timedelta
@@ -10,9 +11,16 @@ import json
 import urllib.parse
 from collections import deque
 import re
-import aiohttp
+import aiofiles
+from concurrent.futures import ThreadPoolExecutor
 from aliexpress_api import AliexpressApi, models
 
+# Prefer the C-based orjson for persistence, fall back to the stdlib json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Load environment variables
 load_dotenv()
 
@@ -25,7 +33,33 @@ logger = logging.getLogger(__name__)
 
 # File to store active chats and links
 CHATS_FILE = 'active_chats.json'
-LINKS_FILE = 'affiliate_links.json'
+LINKS_FILE = 'affiliate_links.jsonl'
+
+# Links are kept in an append-only log, one JSON object per line. The head file
+# records how many entries at the start of the log were already sent.
+LINKS_HEAD_FILE = 'affiliate_links.head'
+
+# Links file used before the append-only log, imported on first startup
+LEGACY_LINKS_FILE = 'affiliate_links.json'
+
+# Allowlist for AliExpress product URLs, capturing the numeric product ID
+AE_URL_RE = re.compile(r'^https?://(?:[a-z0-9-]+\.)?aliexpress\.(?:com|us|ru)/item/(\d+)\.html', re.IGNORECASE)
+
+# Stay below Telegram's 4096 character limit for a single message
+MAX_MESSAGE_LENGTH = 4000
+
+# Maximum number of queued deals sent to one chat per broadcast, to stay under
+# Telegram's per-group rate limit (about 20 messages a minute)
+BATCH_PER_CHAT = 5
+
+# Separates deals batched into one message
+DEAL_SEPARATOR = "\n\n━━━\n\n"
+
+# Maximum Telegram messages sent per second across all chats (Telegram allows about 30)
+SEND_RATE_LIMIT = 25
+
+# Minimum number of pooled connections to the Telegram API
+TELEGRAM_POOL_SIZE = 64
 
 # Get environment variables
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -42,81 +76,221 @@ aliexpress = AliexpressApi(
     AFFILIATE_ID
 )
 
+# Maximum number of links waiting in the queue
+MAX_QUEUED_LINKS = 10_000
+QUEUE_FULL_MESSAGE = (
+    f"❌ התור מלא ({MAX_QUEUED_LINKS} קישורים)\n\n"
+    "יש לפרסם או למחוק קישורים לפני הוספת קישור חדש"
+)
+
+# Thread pool for the blocking AliExpress SDK calls, so they never stall the event loop
+api_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='aliexpress')
+
 # Initialize link queue
 link_queue = deque()
 
+# Number of already-sent entries at the start of LINKS_FILE
+links_head = 0
+
+# Send slots for acquire_send_slot(), each held for one second
+send_semaphore = asyncio.Semaphore(SEND_RATE_LIMIT)
+
+# Serializes changes to link_queue and their writes to disk
+links_lock = asyncio.Lock()
+
+def encode_json(data):
+    """Encode data as compact UTF-8 JSON."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def decode_json(data):
+    """Decode JSON from bytes or str."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def write_file_atomic(path, data):
+    """Write bytes to a temporary file, then swap it in place."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb', buffering=1 << 16) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+async def write_file_atomic_async(path, data):
+    """Write bytes to a temporary file without blocking the event loop, then swap it in place."""
+    tmp_path = path + '.tmp'
+    async with aiofiles.open(tmp_path, 'wb') as f:
+        await f.write(data)
+    os.replace(tmp_path, path)
+
+def encode_links_log(links):
+    """Encode links as the lines of the links log."""
+    return b''.join(encode_json(link) + b'\n' for link in links)
+
+def read_links_head():
+    """Read how many entries at the start of the links log were already sent."""
+    if os.path.exists(LINKS_HEAD_FILE):
+        with open(LINKS_HEAD_FILE, 'r') as f:
+            return int(f.read().strip() or 0)
+    return 0
+
+def write_links_log(links):
+    """Rewrite the links log so it holds exactly the given pending links."""
+    global links_head
+    # Reset the head before swapping the log: a crash in between re-sends links rather than losing them
+    write_file_atomic(LINKS_HEAD_FILE, b'0')
+    write_file_atomic(LINKS_FILE, encode_links_log(links))
+    links_head = 0
+
 def load_links():
-    """Load affiliate links from file."""
+    """Load pending affiliate links and compact the links log down to them."""
     try:
         if os.path.exists(LINKS_FILE):
-            with open(LINKS_FILE, 'r') as f:
-                return deque(json.load(f))
-        return deque()
+            entries = []
+            with open(LINKS_FILE, 'rb') as f:
+                for line in f:
+                    try:
+                        entries.append(decode_json(line))
+                    except ValueError:
+                        # Only a write interrupted by a crash leaves a torn line behind
+                        logger.warning(f"Skipping unreadable line in {LINKS_FILE}")
+            links = deque(entries[read_links_head():])
+        elif os.path.exists(LEGACY_LINKS_FILE):
+            with open(LEGACY_LINKS_FILE, 'rb') as f:
+                links = deque(decode_json(f.read()))
+        else:
+            return deque()
+
+        write_links_log(links)
+        return links
     except Exception as e:
         logger.error(f"Error loading links: {e}")
         return deque()
 
-def save_links():
-    """Save affiliate links to file."""
+async def save_links():
+    """Compact the links log down to the links still in the queue, without blocking the event loop."""
+    global links_head
     try:
-        with open(LINKS_FILE, 'w') as f:
-            json.dump(list(link_queue), f)
+        data = encode_links_log(link_queue)
+        # Same order as write_links_log: reset the head before swapping the log
+        await write_file_atomic_async(LINKS_HEAD_FILE, b'0')
+        await write_file_atomic_async(LINKS_FILE, data)
+        links_head = 0
     except Exception as e:
         logger.error(f"Error saving links: {e}")
 
+async def append_link(link):
+    """Add a link to the end of the queue and of the links log.
+
+    Returns 'added', or 'duplicate' / 'full' if the link was rejected.
+    """
+    async with links_lock:
+        # Re-check under the lock; the handler's checks run before the API calls
+        if link['product_id'] in queued_product_ids:
+            return 'duplicate'
+        if len(link_queue) >= MAX_QUEUED_LINKS:
+            return 'full'
+        link_queue.append(link)
+        queued_product_ids.add(link['product_id'])
+        try:
+            async with aiofiles.open(LINKS_FILE, 'ab') as f:
+                await f.write(encode_json(link) + b'\n')
+        except Exception as e:
+            logger.error(f"Error saving link: {e}")
+        return 'added'
+
+async def pop_links(count):
+    """Take up to count links from the front of the queue and move the log head past them."""
+    global links_head
+    async with links_lock:
+        links = [link_queue.popleft() for _ in range(min(count, len(link_queue)))]
+        if not links:
+            return links
+        queued_product_ids.difference_update(link['product_id'] for link in links)
+
+        links_head += len(links)
+        try:
+            # Compact once more than half of the log is already-sent links
+            if links_head > len(link_queue):
+                await save_links()
+            else:
+                await write_file_atomic_async(LINKS_HEAD_FILE, str(links_head).encode())
+        except Exception as e:
+            logger.error(f"Error saving links head: {e}")
+        return links
+
+async def clear_links():
+    """Remove all links from the queue and the links log."""
+    async with links_lock:
+        link_queue.clear()
+        queued_product_ids.clear()
+        await save_links()
+
 # Load existing links on startup
 link_queue = load_links()
 
+# Product IDs currently in link_queue, to reject duplicates without scanning the queue
+queued_product_ids = {link['product_id'] for link in link_queue}
+
 def load_chats():
     """Load active chats from file."""
     try:
         if os.path.exists(CHATS_FILE):
-            with open(CHATS_FILE, 'r') as f:
-                return json.load(f)
+            with open(CHATS_FILE, 'rb') as f:
+                return decode_json(f.read())
         return {}
     except Exception as e:
         logger.error(f"Error loading chats: {e}")
         return {}
 
-def save_chats(chats):
-    """Save active chats to file."""
+async def save_chats(chats):
+    """Save active chats to file without blocking the event loop."""
     try:
-        with open(CHATS_FILE, 'w') as f:
-            json.dump(chats, f)
+        await write_file_atomic_async(CHATS_FILE, encode_json(chats))
     except Exception as e:
         logger.error(f"Error saving chats: {e}")
 
+# Load active chats once on startup and keep them in memory
+active_chats = load_chats()
+
+# Serializes changes to active_chats and their writes to disk
+chats_lock = asyncio.Lock()
+
 async def handle_new_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle when bot is added to a new group."""
     chat = update.effective_chat
     if chat.type in ['group', 'supergroup']:
-        chats = load_chats()
-        chats[str(chat.id)] = chat.title
-        save_chats(chats)
+        async with chats_lock:
+            active_chats[str(chat.id)] = chat.title
+            await save_chats(active_chats)
         logger.info(f"Added new chat: {chat.title} (ID: {chat.id})")
 
 async def get_chats(bot):
-    """Get all active chats from the stored file."""
-    chats = load_chats()
-    return [(int(chat_id), title) for chat_id, title in chats.items()]
+    """Get a snapshot of all active chats, safe to broadcast from while new chats are added."""
+    async with chats_lock:
+        return [(int(chat_id), title) for chat_id, title in active_chats.items()]
 
-async def extract_product_id(url):
-    """Extract product ID from AliExpress URL."""
-    try:
-        # Extract product ID from URL
-        match = re.search(r'item/(\d+)', url)
-        if match:
-            return match.group(1)
-        return None
-    except Exception as e:
-        logger.error(f"Error extracting product ID: {e}")
-        return None
+async def run_api_call(func, *args):
+    """Run a blocking AliExpress SDK call on the shared API thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(api_executor, func, *args)
+
+async def post_shutdown(application: Application):
+    """Release resources once the bot has stopped."""
+    api_executor.shutdown(wait=False, cancel_futures=True)
+
+def extract_product_id(url: str) -> str | None:
+    """Extract product ID from AliExpress URL, or None if it isn't an AliExpress product URL."""
+    if match := AE_URL_RE.match(url):
+        return match.group(1)
+    return None
 
 async def fetch_product_details(url):
     """Fetch product details using the AliExpress API."""
     try:
         # Get product details using the API
-        products = aliexpress.get_products_details([url])
+        products = await run_api_call(aliexpress.get_products_details, [url])
         if not products:
             logger.error("No product details found")
             return None
@@ -135,7 +309,7 @@ async def generate_affiliate_link(url, tracking_id):
     """Generate an affiliate link using the AliExpress API."""
     try:
         # Get affiliate link using the API
-        affiliate_links = aliexpress.get_affiliate_links(url)
+        affiliate_links = await run_api_call(aliexpress.get_affiliate_links, url)
         if not affiliate_links:
             logger.error("No affiliate links generated")
             return None
@@ -161,31 +335,48 @@ async def handle_add_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
+    status = None
     try:
         # Get the URL from the command
         url = context.args[0]
         
-        # Extract product ID
-        await update.message.reply_text("⏳ מאתר מזהה המוצר...")
-        product_id = await extract_product_id(url)
+        # Validate the URL and extract the product ID before spending any API calls on it
+        product_id = extract_product_id(url)
         if not product_id:
-            await update.message.reply_text("❌ לא ניתן למצוא את מזהה המוצר בקישור")
+            await update.message.reply_text("❌ קישור לא תקין - יש להזין קישור למוצר מאליאקספרס")
+            return
+
+        # Skip products that are already queued before spending API calls on them
+        if product_id in queued_product_ids:
+            await update.message.reply_text("❌ המוצר כבר נמצא בתור הקישורים")
+            return
+
+        # Keep the queue (and the links log) bounded
+        if len(link_queue) >= MAX_QUEUED_LINKS:
+            await update.message.reply_text(QUEUE_FULL_MESSAGE)
             return
         
-        # Fetch product details
-        await update.message.reply_text("⏳ מאתר פרטי המוצר...")
-        product_details = await fetch_product_details(url)
+        # Fetch product details and generate the affiliate link concurrently.
+        # A single status message is sent and later edited into the result.
+        status = await update.message.reply_text("⏳ מאתר פרטי המוצר ומייצר קישור שותפים...")
+        product_details, affiliate_link = await asyncio.gather(
+            fetch_product_details(url),
+            generate_affiliate_link(url, AFFILIATE_ID),
+            return_exceptions=True
+        )
+        if isinstance(product_details, Exception):
+            logger.error(f"Error fetching product details: {product_details}")
+            product_details = None
+        if isinstance(affiliate_link, Exception):
+            logger.error(f"Error generating affiliate link: {affiliate_link}")
+            affiliate_link = None
         
         if not product_details:
-            await update.message.reply_text("❌ לא ניתן לאתר את פרטי המוצר")
+            await status.edit_text("❌ לא ניתן לאתר את פרטי המוצר")
             return
         
-        # Generate affiliate link
-        await update.message.reply_text("⏳ מייצר קישור שותפים...")
-        affiliate_link = await generate_affiliate_link(url, AFFILIATE_ID)
-        
         if not affiliate_link:
-            await update.message.reply_text("❌ לא ניתן לייצר קישור שותפים")
+            await status.edit_text("❌ לא ניתן לייצר קישור שותפים")
             return
         
         # Create a new link entry
@@ -197,18 +388,49 @@ async def handle_add_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
         }
 
         # Add to queue
-        link_queue.append(new_link)
-        save_links()
+        result = await append_link(new_link)
+        if result == 'duplicate':
+            await status.edit_text("❌ המוצר כבר נמצא בתור הקישורים")
+            return
+        if result == 'full':
+            await status.edit_text(QUEUE_FULL_MESSAGE)
+            return
 
         # Send confirmation
-        await update.message.reply_text(
+        await status.edit_text(
             "✅ קישור חדש נוסף בהצלחה!\n\n"
             f"כותרת: {product_details['title']}\n\n"
             f"קישור שותפים: {affiliate_link}"
         )
     except Exception as e:
         logger.error(f"Error adding link: {e}")
-        await update.message.reply_text("❌ אירעה שגיאה בהוספת הקישור")
+        error_text = "❌ אירעה שגיאה בהוספת הקישור"
+        # Edit the status message if it was already sent, so the user isn't left with a stale "⏳"
+        if status:
+            try:
+                await status.edit_text(error_text)
+                return
+            except Exception as edit_error:
+                logger.error(f"Error editing status message: {edit_error}")
+        await update.message.reply_text(error_text)
+
+def split_message(parts, limit=MAX_MESSAGE_LENGTH, separator=''):
+    """Join message parts into as few chunks as possible, each at most limit characters."""
+    chunks = []
+    current = []
+    length = 0
+    for part in parts:
+        added = len(part) + (len(separator) if current else 0)
+        if current and length + added > limit:
+            chunks.append(separator.join(current))
+            current = []
+            length = 0
+            added = len(part)
+        current.append(part)
+        length += added
+    if current:
+        chunks.append(separator.join(current))
+    return chunks
 
 async def handle_list_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the /listlinks command to show all stored links."""
@@ -221,14 +443,16 @@ async def handle_list_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ אין קישורים שמורים")
         return
 
-    message = "📋 רשימת הקישורים השמורים:\n\n"
-    for i, link in enumerate(link_queue, 1):
-        message += (
-            f"{i}. {link['title']}\n"
-            f"   קישור שותפים: {link['affiliate_link']}\n\n"
-        )
+    parts = ["📋 רשימת הקישורים השמורים:\n\n"]
+    parts.extend(
+        f"{i}. {link['title']}\n"
+        f"   קישור שותפים: {link['affiliate_link']}\n\n"
+        for i, link in enumerate(link_queue, 1)
+    )
 
-    await update.message.reply_text(message)
+    # Send in order, one message per chunk that fits Telegram's length limit
+    for message in split_message(parts):
+        await update.message.reply_text(message)
 
 async def handle_clear_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the /clearlinks command to clear all stored links."""
@@ -237,37 +461,62 @@ async def handle_clear_links(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("❌ פקודה זו זמינה רק בצ'אט פרטי")
         return
 
-    link_queue.clear()
-    save_links()
+    await clear_links()
     await update.message.reply_text("✅ כל הקישורים נמחקו בהצלחה")
 
-async def send_deal_to_chat(bot, chat_id, chat_title):
-    """Send a deal with affiliate link to a specific chat."""
-    try:
-        if not link_queue:
-            logger.warning("No links available in queue")
-            return
-
-        # Get the next link from the queue and remove it
-        deal = link_queue.popleft()
-        save_links()
+async def acquire_send_slot():
+    """Wait until a message may be sent without exceeding SEND_RATE_LIMIT messages per second."""
+    await send_semaphore.acquire()
+    # Hand the slot back a second later rather than when the send finishes,
+    # which caps the send rate and not just the number of sends in flight
+    asyncio.get_running_loop().call_later(1, send_semaphore.release)
+
+def format_deal(deal):
+    """Render the message text for a single deal."""
+    return (
+        f"🔥 {deal['title']}\n\n"
+        f"🛒 קישור למוצר: {deal['affiliate_link']}"
+    )
 
-        message = (
-            f"🔥 {deal['title']}\n\n"
-            f"🛒 קישור למוצר: {deal['affiliate_link']}"
-        )
-        await bot.send_message(
-            chat_id=chat_id,
-            text=message
-        )
-        logger.info(f"Sent deal to {chat_title} (ID: {chat_id})")
+async def send_deal_to_chat(bot, chat_id, chat_title, messages):
+    """Send pre-rendered deal messages to a specific chat."""
+    try:
+        for message in messages:
+            await acquire_send_slot()
+            await bot.send_message(
+                chat_id=chat_id,
+                text=message
+            )
+        logger.info(f"Sent {len(messages)} deal message(s) to {chat_title} (ID: {chat_id})")
     except Exception as e:
-        logger.error(f"Error sending deal to {chat_title}: {e}")
+        logger.error(f"Error sending deals to {chat_title}: {e}")
 
 async def send_deals_to_all(bot, chats):
-    """Send deals to all group chats."""
-    for chat_id, chat_title in chats:
-        await send_deal_to_chat(bot, chat_id, chat_title)
+    """Send deals to all group chats concurrently, up to BATCH_PER_CHAT queued links per chat."""
+    # Take this round's links up front so concurrent sends never share one
+    deals = await pop_links(BATCH_PER_CHAT * len(chats))
+    if len(deals) < len(chats):
+        logger.warning(f"No links available in queue for {len(chats) - len(deals)} chat(s)")
+    if not deals:
+        return
+
+    # Render every message before the fan-out, then deal the links out round-robin
+    # so every chat gets one before any gets a second
+    rendered = [format_deal(deal) for deal in deals]
+    chats = chats[:len(deals)]
+    batches = [
+        split_message(rendered[i::len(chats)], separator=DEAL_SEPARATOR)
+        for i in range(len(chats))
+    ]
+    results = await asyncio.gather(
+        *(send_deal_to_chat(bot, chat_id, chat_title, messages)
+          for (chat_id, chat_title), messages in zip(chats, batches)),
+        return_exceptions=True
+    )
+
+    for (chat_id, chat_title), result in zip(chats, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error sending deals to {chat_title} (ID: {chat_id}): {result}")
 
 async def handle_publish_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the /publish command."""
@@ -288,7 +537,7 @@ async def handle_publish_command(update: Update, context: ContextTypes.DEFAULT_T
             await update.message.reply_text("❌ אירעה שגיאה בשליחת הקישורים")
     else:
         # If command is used in a group, send deal only to that group
-        await send_deal_to_chat(bot, chat.id, chat.title)
+        await send_deals_to_all(bot, [(chat.id, chat.title)])
 
 async def scheduled_deals(context: ContextTypes.DEFAULT_TYPE):
     """Send deals on schedule."""
@@ -321,13 +570,13 @@ async def test_api_connection(update: Update, context: ContextTypes.DEFAULT_TYPE
             f"Tracking ID: {AFFILIATE_ID}"
         )
 
-        # Try to fetch product details
-        product_details = await fetch_product_details(test_url)
+        # Try to fetch product details and generate an affiliate link together
+        product_details, affiliate_link = await asyncio.gather(
+            fetch_product_details(test_url),
+            generate_affiliate_link(test_url, AFFILIATE_ID)
+        )
         
         if product_details:
-            # Try to generate an affiliate link
-            affiliate_link = await generate_affiliate_link(test_url, AFFILIATE_ID)
-            
             if affiliate_link:
                 await update.message.reply_text(
                     "✅ החיבור ל-API עובד בהצלחה!\n\n"
@@ -351,11 +600,32 @@ async def test_api_connection(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 def main():
     """Main function to run the bot."""
+    # Fail fast on a missing token instead of deep inside the HTTP client
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("TELEGRAM_BOT_TOKEN is not set")
+        raise SystemExit(1)
+
     # Create the Application with job queue
     application = (
         Application.builder()
-        .token(os.getenv('TELEGRAM_BOT_TOKEN'))
+        .token(TELEGRAM_BOT_TOKEN)
         .concurrent_updates(True)
+        # HTTP/2 keep-alive pool for Telegram calls, so concurrent sends share one
+        # connection, with room for one stream per group during a broadcast
+        .request(HTTPXRequest(
+            connection_pool_size=max(TELEGRAM_POOL_SIZE, len(active_chats)),
+            pool_timeout=30,
+            connect_timeout=10,
+            read_timeout=20,
+            http_version="2"
+        ))
+        # Long polling gets its own small pool so it never starves outgoing messages
+        .get_updates_request(HTTPXRequest(
+            connection_pool_size=2,
+            pool_timeout=30,
+            http_version="2"
+        ))
+        .post_shutdown(post_shutdown)
         .build()
     )
     
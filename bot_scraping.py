@@ -1,19 +1,51 @@
+"""Telegram bot that scrapes AliExpress product pages and publishes affiliate links to groups.
+
+All HTTP must go through get_session() (aiohttp). Blocking clients such as
+requests would stall the event loop and every other handler with it.
+"""
 import os
 import logging
 from dotenv import load_dotenv
-from telegram import Bot, Update
+from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 import asyncio
-from datetime import datetime, timedelta
+from datetime import timedelta
 import random
 import json
 import urllib.parse
-from collections import deque
 import re
-import requests
-from bs4 import BeautifulSoup
+import tempfile
+from html import unescape
+from selectolax.lexbor import LexborHTMLParser
 import aiohttp
 
+# Prefer the C-based orjson for persistence, fall back to the stdlib json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Matches the numeric product ID in AliExpress item URLs
+ITEM_ID_RE = re.compile(r'item/(\d+)')
+
+# Matches the og:title meta tag in raw page bytes, so the title can be read while streaming
+OG_TITLE_RE = re.compile(rb'<meta[^>]*?property=["\']og:title["\'][^>]*?content=(["\'])(.*?)\1', re.IGNORECASE | re.DOTALL)
+
+# Bytes of the streamed page kept for OG_TITLE_RE, enough to hold a tag split across chunks
+OG_TITLE_WINDOW = 32 * 1024
+
+# Fallback title elements, tried in order when the page has no og:title meta tag
+TITLE_SELECTORS = [
+    'h1.product-title',
+    'div.product-title',
+    'h1[data-spm-anchor-id]',
+    'div[data-spm-anchor-id]',
+    'h1.title',
+    'div.title',
+    'h1.product-name',
+    'div.product-name'
+]
+
 # Load environment variables
 load_dotenv()
 
@@ -28,31 +60,114 @@ logger = logging.getLogger(__name__)
 CHATS_FILE = 'active_chats.json'
 LINKS_FILE = 'affiliate_links.json'
 
+# Stay below Telegram's 4096 character limit for a single message
+MAX_MESSAGE_LENGTH = 4000
+
+# Maximum Telegram messages sent per second across all chats (Telegram allows about 30)
+SEND_RATE_LIMIT = 25
+
+# How often (in seconds) pending link queue changes are written to disk
+LINKS_FLUSH_INTERVAL = 5
+
 # Get affiliate ID and API key from environment
 AFFILIATE_ID = os.getenv('ALIEXPRESS_AFFILIATE_ID')
 API_KEY = os.getenv('ALIEXPRESS_API_KEY')
 
-# Initialize link queue
-link_queue = deque()
+# Browser-like headers sent with every AliExpress request
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1'
+}
+
+# Shared HTTP session for AliExpress requests, created lazily by get_session()
+http_session = None
+
+# Initialize link queue. A list rather than a deque: /updatelink indexes into it
+# and broadcasts take their links from the front in a single slice.
+link_queue = []
+
+# Set when link_queue changed since it was last written to disk
+links_dirty = False
+
+# Serializes writes of the link queue and of the chats file to disk
+links_lock = asyncio.Lock()
+chats_lock = asyncio.Lock()
+
+# Background task running flush_links_loop(), started by post_init()
+flush_task = None
+
+# Send slots for send_bounded(), each held for one second
+send_semaphore = asyncio.Semaphore(SEND_RATE_LIMIT)
+
+def read_json(path):
+    """Read and parse a JSON file."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def write_json(path, data):
+    """Write data as JSON to a file (blocking, run it in a worker thread)."""
+    if orjson is not None:
+        encoded = orjson.dumps(data)
+    else:
+        encoded = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    # Write a uniquely named temporary file and swap it in, so a crash never leaves a torn file behind
+    with tempfile.NamedTemporaryFile(
+        'wb', buffering=1 << 16, dir=os.path.dirname(path) or '.',
+        prefix=os.path.basename(path) + '.', suffix='.tmp', delete=False
+    ) as f:
+        f.write(encoded)
+    try:
+        os.replace(f.name, path)
+    except Exception:
+        os.remove(f.name)
+        raise
 
 def load_links():
     """Load affiliate links from file."""
     try:
         if os.path.exists(LINKS_FILE):
-            with open(LINKS_FILE, 'r') as f:
-                return deque(json.load(f))
-        return deque()
+            return read_json(LINKS_FILE)
+        return []
     except Exception as e:
         logger.error(f"Error loading links: {e}")
-        return deque()
+        return []
 
-def save_links():
-    """Save affiliate links to file."""
+async def save_links():
+    """Save affiliate links to file without blocking the event loop. Returns whether the write succeeded."""
     try:
-        with open(LINKS_FILE, 'w') as f:
-            json.dump(list(link_queue), f)
+        await asyncio.to_thread(write_json, LINKS_FILE, list(link_queue))
+        return True
     except Exception as e:
         logger.error(f"Error saving links: {e}")
+        return False
+
+def mark_links_dirty():
+    """Mark the link queue as changed so the next flush writes it to disk."""
+    global links_dirty
+    links_dirty = True
+
+async def flush_links():
+    """Write the link queue to disk if it changed since the last flush."""
+    global links_dirty
+    async with links_lock:
+        if links_dirty:
+            # Cleared up front so changes made during the write mark the queue dirty again
+            links_dirty = False
+            if not await save_links():
+                # Keep the changes pending so the next flush retries the write
+                links_dirty = True
+
+async def flush_links_loop():
+    """Periodically flush link queue changes to disk."""
+    while True:
+        await asyncio.sleep(LINKS_FLUSH_INTERVAL)
+        await flush_links()
 
 # Load existing links on startup
 link_queue = load_links()
@@ -65,144 +180,185 @@ def create_affiliate_link(product_id):
         "aff_trace_key": AFFILIATE_ID,
         "item_id": product_id
     }
-    return f"{base_url}{urllib.parse.quote_plus(str(params))}"
+    return f"{base_url}?{urllib.parse.urlencode(params)}"
 
 def load_chats():
     """Load active chats from file."""
     try:
         if os.path.exists(CHATS_FILE):
-            with open(CHATS_FILE, 'r') as f:
-                return json.load(f)
+            return read_json(CHATS_FILE)
         return {}
     except Exception as e:
         logger.error(f"Error loading chats: {e}")
         return {}
 
-def save_chats(chats):
-    """Save active chats to file."""
+async def save_chats():
+    """Save active chats to file without blocking the event loop."""
     try:
-        with open(CHATS_FILE, 'w') as f:
-            json.dump(chats, f)
+        async with chats_lock:
+            await asyncio.to_thread(write_json, CHATS_FILE, dict(active_chats))
     except Exception as e:
         logger.error(f"Error saving chats: {e}")
 
+# Load active chats once on startup and keep them in memory
+active_chats = load_chats()
+
 async def handle_new_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle when bot is added to a new group."""
     chat = update.effective_chat
     if chat.type in ['group', 'supergroup']:
-        chats = load_chats()
-        chats[str(chat.id)] = chat.title
-        save_chats(chats)
+        active_chats[str(chat.id)] = chat.title
+        await save_chats()
         logger.info(f"Added new chat: {chat.title} (ID: {chat.id})")
 
 async def get_chats(bot):
-    """Get all active chats from the stored file."""
-    chats = load_chats()
-    return [(int(chat_id), title) for chat_id, title in chats.items()]
+    """Get all active chats."""
+    return [(int(chat_id), title) for chat_id, title in active_chats.items()]
+
+async def get_session():
+    """Get the shared aiohttp session, creating it on first use."""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, limit_per_host=10, enable_cleanup_closed=True),
+            timeout=aiohttp.ClientTimeout(total=60, connect=10),
+            headers=DEFAULT_HEADERS
+        )
+    return http_session
+
+async def close_session():
+    """Close the shared aiohttp session."""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+async def post_init(application: Application):
+    """Start background tasks once the bot's event loop is running."""
+    global flush_task
+    # A plain task rather than a job, so flushing works without the optional job-queue extra
+    flush_task = asyncio.create_task(flush_links_loop())
+
+async def post_shutdown(application: Application):
+    """Release resources once the bot has stopped."""
+    if flush_task is not None:
+        flush_task.cancel()
+    await flush_links()
+    await close_session()
 
 async def extract_product_id(url):
     """Extract product ID from AliExpress URL, handling both direct and affiliate links."""
     try:
         # If it's a direct AliExpress URL, extract the ID directly
         if 'aliexpress.com/item/' in url:
-            match = re.search(r'item/(\d+)', url)
+            match = ITEM_ID_RE.search(url)
             if match:
                 return match.group(1)
             return None
 
-        # For affiliate links, we need to follow the redirect
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1'
-        }
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers, allow_redirects=True) as response:
-                if response.status != 200:
-                    logger.error(f"Failed to follow redirect. Status: {response.status}")
-                    return None
-                
-                # Get the final URL after all redirects
+        # For affiliate links, we need to follow the redirect. Only the final URL
+        # is needed, so follow the redirects with HEAD to skip the body
+        session = await get_session()
+        async with session.head(url, allow_redirects=True) as response:
+            status = response.status
+            final_url = str(response.url)
+
+        # Some servers reject HEAD; retry with GET but never read the body
+        if status == 405:
+            async with session.get(url, allow_redirects=True) as response:
+                status = response.status
                 final_url = str(response.url)
-                logger.info(f"Final URL after redirects: {final_url}")
-                
-                # Extract product ID from the final URL
-                match = re.search(r'item/(\d+)', final_url)
-                if match:
-                    return match.group(1)
-                
-                return None
+
+        if status != 200:
+            logger.error(f"Failed to follow redirect. Status: {status}")
+            return None
+        
+        logger.info(f"Final URL after redirects: {final_url}")
+        
+        # Extract product ID from the final URL
+        match = ITEM_ID_RE.search(final_url)
+        if match:
+            return match.group(1)
+        
+        return None
     except Exception as e:
         logger.error(f"Error extracting product ID: {e}")
         return None
 
-async def fetch_product_details(url):
-    """Fetch product title from AliExpress URL."""
+def parse_product_title(html):
+    """Find the product title in an AliExpress product page."""
+    tree = LexborHTMLParser(html)
+    
+    # Try to find title in meta tags first (most reliable)
+    meta_title = tree.css_first('meta[property="og:title"]')
+    if meta_title:
+        title = (meta_title.attributes.get('content') or '').strip()
+        logger.info(f"Found title in meta tag: {title}")
+        return title
+    
+    # Fallback to other title selectors
+    for selector in TITLE_SELECTORS:
+        title_elem = tree.css_first(selector)
+        if title_elem:
+            title = title_elem.text(strip=True)
+            logger.info(f"Found title using selector '{selector}': {title}")
+            return title
+    
+    logger.error("Could not find product title")
+    return None
+
+async def read_product_title(response):
+    """Read a product page body, stopping as soon as its og:title meta tag has arrived."""
+    encoding = response.charset or 'utf-8'
+    chunks = []
+    window = b''
+    async for chunk in response.content.iter_chunked(4096):
+        chunks.append(chunk)
+        window = (window + chunk)[-OG_TITLE_WINDOW:]
+        match = OG_TITLE_RE.search(window)
+        if match:
+            # The rest of the page isn't needed, drop the connection instead of downloading it
+            response.close()
+            title = unescape(match.group(2).decode(encoding, errors='replace')).strip()
+            logger.info(f"Found title in meta tag: {title}")
+            return title
+
+    # No og:title tag matched, parse the full page for the fallback selectors
+    return parse_product_title(b''.join(chunks).decode(encoding, errors='replace'))
+
+async def fetch_product(url):
+    """Fetch an AliExpress product page once and extract both its product ID and title."""
     try:
-        # Headers for the request
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1'
-        }
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                if response.status != 200:
-                    logger.error(f"Failed to fetch product page. Status: {response.status}")
-                    return None
-                
-                html = await response.text()
-                soup = BeautifulSoup(html, 'html.parser')
-                
-                # Try to find title in meta tags first (most reliable)
-                meta_title = soup.find('meta', property='og:title')
-                if meta_title:
-                    title = meta_title.get('content', '').strip()
-                    logger.info(f"Found title in meta tag: {title}")
-                    return {
-                        "title": title,
-                        "url": url
-                    }
-                
-                # Fallback to other title selectors
-                title_selectors = [
-                    'h1.product-title',
-                    'div.product-title',
-                    'h1[data-spm-anchor-id]',
-                    'div[data-spm-anchor-id]',
-                    'h1.title',
-                    'div.title',
-                    'h1.product-name',
-                    'div.product-name'
-                ]
-                
-                for selector in title_selectors:
-                    title_elem = soup.select_one(selector)
-                    if title_elem:
-                        title = title_elem.get_text(strip=True)
-                        logger.info(f"Found title using selector '{selector}': {title}")
-                        return {
-                            "title": title,
-                            "url": url
-                        }
-                
-                logger.error("Could not find product title")
+        session = await get_session()
+        async with session.get(url, allow_redirects=True) as response:
+            if response.status != 200:
+                logger.error(f"Failed to fetch product page. Status: {response.status}")
                 return None
+            
+            final_url = str(response.url)
+            title = await read_product_title(response)
+
+        # Direct item URLs carry the ID themselves, affiliate links only after the redirects
+        if 'aliexpress.com/item/' in url:
+            match = ITEM_ID_RE.search(url)
+        else:
+            logger.info(f"Final URL after redirects: {final_url}")
+            match = ITEM_ID_RE.search(final_url)
+
+        return {
+            "product_id": match.group(1) if match else None,
+            "title": title,
+            "final_url": final_url
+        }
     except Exception as e:
-        logger.error(f"Error fetching product details: {e}")
+        logger.error(f"Error fetching product: {e}")
         return None
 
 async def generate_affiliate_link(url, tracking_id):
     """Generate affiliate link using AliExpress portal link generator format."""
     try:
-        # Extract product ID from URL
-        product_id = extract_product_id(url)
+        # Extract product ID from URL (direct item URLs resolve without a network hop)
+        product_id = await extract_product_id(url)
         if not product_id:
             return None
 
@@ -242,37 +398,37 @@ async def handle_add_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Get the URL from the command
         url = context.args[0]
         
-        # Extract product ID (now async)
-        await update.message.reply_text("⏳ מאתר מזהה המוצר...")
-        product_id = await extract_product_id(url)
-        if not product_id:
+        # Fetch the product page once for both its product ID and title
+        await update.message.reply_text("⏳ מאתר מזהה ופרטי המוצר...")
+        product = await fetch_product(url)
+        if not product:
+            await update.message.reply_text("❌ לא ניתן לאתר את פרטי המוצר")
+            return
+
+        if not product["product_id"]:
             await update.message.reply_text("❌ לא ניתן למצוא את מזהה המוצר בקישור")
             return
         
-        # Fetch product details
-        await update.message.reply_text("⏳ מאתר פרטי המוצר...")
-        product_details = await fetch_product_details(url)
-        
-        if not product_details:
+        if not product["title"]:
             await update.message.reply_text("❌ לא ניתן לאתר את פרטי המוצר")
             return
         
         # Create a new link entry
         new_link = {
-            "title": product_details["title"],
-            "product_id": product_id,
+            "title": product["title"],
+            "product_id": product["product_id"],
             "url": url,
             "affiliate_link": url  # Using the original URL as affiliate link for now
         }
 
         # Add to queue
         link_queue.append(new_link)
-        save_links()
+        mark_links_dirty()
 
         # Send confirmation
         await update.message.reply_text(
             "✅ קישור חדש נוסף בהצלחה!\n\n"
-            f"כותרת: {product_details['title']}\n\n"
+            f"כותרת: {product['title']}\n\n"
             f"קישור: {url}"
         )
     except Exception as e:
@@ -314,7 +470,7 @@ async def handle_update_link(update: Update, context: ContextTypes.DEFAULT_TYPE)
             "original_price": original_price,
             "discount": discount
         })
-        save_links()
+        mark_links_dirty()
 
         await update.message.reply_text(
             "✅ פרטי המוצר עודכנו בהצלחה!\n\n"
@@ -327,6 +483,22 @@ async def handle_update_link(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.error(f"Error updating link: {e}")
         await update.message.reply_text("❌ אירעה שגיאה בעדכון פרטי המוצר")
 
+def split_message(parts, limit=MAX_MESSAGE_LENGTH):
+    """Join message parts into as few chunks as possible, each at most limit characters."""
+    chunks = []
+    current = []
+    length = 0
+    for part in parts:
+        if current and length + len(part) > limit:
+            chunks.append(''.join(current))
+            current = []
+            length = 0
+        current.append(part)
+        length += len(part)
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
 async def handle_list_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the /listlinks command to show all stored links."""
     chat = update.effective_chat
@@ -338,14 +510,16 @@ async def handle_list_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ אין קישורים שמורים")
         return
 
-    message = "📋 רשימת הקישורים השמורים:\n\n"
+    parts = ["📋 רשימת הקישורים השמורים:\n\n"]
     for i, link in enumerate(link_queue, 1):
-        message += (
+        parts.append(
             f"{i}. {link['title']}\n"
             f"   קישור שותפים: {link['affiliate_link']}\n\n"
         )
 
-    await update.message.reply_text(message)
+    # Send in order, one message per chunk that fits Telegram's length limit
+    for message in split_message(parts):
+        await update.message.reply_text(message)
 
 async def handle_clear_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the /clearlinks command to clear all stored links."""
@@ -355,7 +529,7 @@ async def handle_clear_links(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     link_queue.clear()
-    save_links()
+    mark_links_dirty()
     await update.message.reply_text("✅ כל הקישורים נמחקו בהצלחה")
 
 async def send_sample_deal_to_chat(bot, chat_id, chat_title):
@@ -377,17 +551,9 @@ async def send_sample_deal_to_chat(bot, chat_id, chat_title):
     except Exception as e:
         logger.error(f"Error sending sample deal to {chat_title}: {e}")
 
-async def send_real_deal_to_chat(bot, chat_id, chat_title):
+async def send_real_deal_to_chat(bot, chat_id, chat_title, deal):
     """Send a real deal with affiliate link to a specific chat."""
     try:
-        if not link_queue:
-            logger.warning("No links available in queue")
-            return
-
-        # Get the next link from the queue and remove it
-        deal = link_queue.popleft()  # Use popleft() to remove from the beginning
-        save_links()
-
         message = (
             f"🔥 {deal['title']}\n\n"
             f"🛒 קישור למוצר: {deal['affiliate_link']}"
@@ -400,15 +566,34 @@ async def send_real_deal_to_chat(bot, chat_id, chat_title):
     except Exception as e:
         logger.error(f"Error sending real deal to {chat_title}: {e}")
 
+async def send_bounded(send, *args):
+    """Run a single per-chat send once it fits within SEND_RATE_LIMIT messages per second."""
+    await send_semaphore.acquire()
+    # Hand the slot back a second later rather than when the send finishes,
+    # which caps the send rate and not just the number of sends in flight
+    asyncio.get_running_loop().call_later(1, send_semaphore.release)
+    await send(*args)
+
 async def send_sample_deals_to_all(bot, chats):
     """Send sample deals to all group chats (keep existing)."""
-    for chat_id, chat_title in chats:
-        await send_sample_deal_to_chat(bot, chat_id, chat_title)
+    async with asyncio.TaskGroup() as tg:
+        for chat_id, chat_title in chats:
+            tg.create_task(send_bounded(send_sample_deal_to_chat, bot, chat_id, chat_title))
 
 async def send_real_deals_to_all(bot, chats):
-    """Send real deals to all group chats (new)."""
-    for chat_id, chat_title in chats:
-        await send_real_deal_to_chat(bot, chat_id, chat_title)
+    """Send real deals to all group chats concurrently, one queued link per chat."""
+    # Take all the links for this round up front so concurrent sends never share one
+    deals = link_queue[:len(chats)]
+    del link_queue[:len(deals)]
+    if len(deals) < len(chats):
+        logger.warning(f"No links available in queue for {len(chats) - len(deals)} chat(s)")
+    if not deals:
+        return
+    mark_links_dirty()
+
+    async with asyncio.TaskGroup() as tg:
+        for (chat_id, chat_title), deal in zip(chats, deals):
+            tg.create_task(send_bounded(send_real_deal_to_chat, bot, chat_id, chat_title, deal))
 
 async def handle_publish_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the /publish command."""
@@ -429,7 +614,7 @@ async def handle_publish_command(update: Update, context: ContextTypes.DEFAULT_T
             await update.message.reply_text("❌ אירעה שגיאה בשליחת הקישורים")
     else:
         # If command is used in a group, send deal only to that group
-        await send_real_deal_to_chat(bot, chat.id, chat.title)  # Use real deals
+        await send_real_deals_to_all(bot, [(chat.id, chat.title)])  # Use real deals
 
 async def scheduled_deals(context: ContextTypes.DEFAULT_TYPE):
     """Send deals on schedule."""
@@ -502,12 +687,12 @@ async def handle_check_link_data(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("⏳ סורק את פרטי המוצר...")
         
         # Fetch product details
-        product_details = await fetch_product_details(url)
+        product = await fetch_product(url)
         
-        if product_details:
+        if product and product['title']:
             message = (
                 "✅ פרטי המוצר אותרו בהצלחה!\n\n"
-                f"📝 כותרת: {product_details['title']}\n"
+                f"📝 כותרת: {product['title']}\n"
                 f"🔗 קישור מקורי: {url}"
             )
         else:
@@ -528,6 +713,8 @@ def main():
         Application.builder()
         .token(os.getenv('TELEGRAM_BOT_TOKEN'))
         .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
     